@@ -11,25 +11,45 @@ Ngày tạo: 2024
 """
 
 import asyncio
+import dataclasses
+import functools
+import hashlib
 import json
 import logging
 import os
 import random
+import re
 import time
 from datetime import datetime
-from typing import Dict, List, Optional, Any, Set
-from urllib.parse import urljoin, urlparse
+from types import MappingProxyType
+from typing import Deque, Dict, List, Optional, Any, Set, Tuple
+from urllib.parse import urljoin
 import multiprocessing
 import queue as std_queue
 import signal
+from collections import deque
 
 import aiohttp
-from bs4 import BeautifulSoup
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import HTMLResponse
+from bs4 import BeautifulSoup, SoupStrainer
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import HTMLResponse, Response
 from fake_useragent import UserAgent
 import uvicorn
 
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn, fallback về json chuẩn
+    orjson = None
+
+try:
+    from lxml import etree as lxml_etree
+    from lxml import html as lxml_html
+    HTML_PARSER = 'lxml'  # Parser C, nhanh hơn nhiều so với html.parser
+except ImportError:  # lxml là tùy chọn, fallback về html.parser
+    lxml_etree = None
+    lxml_html = None
+    HTML_PARSER = 'html.parser'
+
 
 # =============================================================================
 # CONFIGURATION
@@ -41,13 +61,23 @@ class Config:
     # Crawler settings
     BASE_URL = "https://www.willhaben.at/iad/gebrauchtwagen/auto/gebrauchtwagenboerse"
     CRAWL_INTERVAL = 3.0  # Giây giữa các lần crawl
+    CRAWL_PAGES = 1  # Số trang kết quả crawl mỗi lần (trang 1..CRAWL_PAGES)
+    FETCH_CONCURRENCY = 3  # Số trang fetch song song tối đa
     MAX_WORKERS = 5  # Số worker async song song
     REQUEST_TIMEOUT = 10  # Timeout cho HTTP requests
+    MAX_SEEN_IDS = 50000  # Số ID đã thấy tối đa được ghi nhớ (tránh rò rỉ bộ nhớ)
+    
+    # HTTP connection pool settings
+    CONNECTION_LIMIT = 0  # Tổng số kết nối tối đa (0 = không giới hạn)
+    CONNECTION_LIMIT_PER_HOST = 30  # Giới hạn thực sự với willhaben.at
+    DNS_CACHE_TTL = 300  # Giây cache DNS
+    KEEPALIVE_TIMEOUT = 75  # Giây giữ kết nối keep-alive
     
     # Anti-detection settings
     MIN_DELAY = 0.5  # Delay tối thiểu giữa requests
     MAX_DELAY = 2.0  # Delay tối đa giữa requests
     USER_AGENT_ROTATION = True
+    USER_AGENT_POOL_SIZE = 64  # Số User-Agent tạo sẵn khi khởi động để xoay vòng
     
     # Proxy settings
     USE_PROXY_ROTATION = False  # Bật/tắt proxy rotation
@@ -64,10 +94,16 @@ class Config:
     
     # WebSocket settings
     MAX_CONNECTIONS = 100
+    WS_SEND_TIMEOUT = 5.0  # Timeout gửi tin cho mỗi client (tránh client chậm giữ broadcast)
+    WS_PING_INTERVAL = 20.0  # Chu kỳ gửi ping frame (giây), client trả pong tự động
+    WS_PING_TIMEOUT = 20.0  # Không nhận pong trong thời gian này thì đóng kết nối
+    WS_QUEUE_SIZE = 1000  # Số tin tối đa chờ gửi cho mỗi client, đầy thì bỏ tin mới
+    WS_BATCH_MAX = 64  # Số tin tối đa lấy ra trong một lần flush của writer
     
     # Logging
     LOG_LEVEL = logging.INFO
     LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    ACCESS_LOG = False  # Log mỗi HTTP request của uvicorn, bật khi cần debug
 
 
 # =============================================================================
@@ -90,6 +126,38 @@ def setup_logging():
 logger = setup_logging()
 
 
+# =============================================================================
+# JSON HELPERS
+# =============================================================================
+
+def _json_default(obj: Any) -> Any:
+    """Serialize các object json chuẩn không hỗ trợ (dataclass)"""
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def json_dumps(obj: Any) -> str:
+    """Serialize JSON (dùng orjson nếu có, nhanh hơn nhiều so với json chuẩn)"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, default=_json_default)
+
+
+def json_dumps_pretty(obj: Any) -> bytes:
+    """Serialize JSON có indent 2 ra bytes UTF-8 để ghi file (dùng orjson nếu có)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False, indent=2, default=_json_default) + '\n').encode('utf-8')
+
+
+def json_loads(data: Any) -> Any:
+    """Parse JSON từ str/bytes (dùng orjson nếu có)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 # =============================================================================
 # PROXY MANAGER
 # =============================================================================
@@ -134,6 +202,18 @@ def _mp_free_proxy_producer(base_url: str, out_q: multiprocessing.Queue, stop_ev
             time.sleep(backoff)
             backoff = min(backoff_max, backoff * 2)
 
+@functools.lru_cache(maxsize=1024)
+def _parse_proxy_host(proxy: str) -> str:
+    """Parse IP/host từ proxy URL (cache vì cùng proxy được parse lặp lại mỗi request)"""
+    # Dạng proxy: [scheme://][user:pass@]host[:port][/...]
+    netloc = proxy.split('://', 1)[-1].split('/', 1)[0]
+    host = netloc.rpartition('@')[2]
+    if host.startswith('['):
+        # IPv6: [addr]:port
+        end = host.find(']')
+        return host[1:end] if end > 0 else proxy
+    return host.split(':', 1)[0] or proxy
+
 class ProxyManager:
     """Quản lý proxy: user proxies (nếu bật) và pool free-proxy chạy nền (multiprocess)."""
     
@@ -164,35 +244,16 @@ class ProxyManager:
     
     def _parse_proxy_ip(self, proxy: str) -> str:
         """Parse IP/host từ proxy URL"""
-        try:
-            parsed = urlparse(proxy)
-            if parsed.hostname:
-                return parsed.hostname
-            elif '@' in parsed.netloc:
-                return parsed.netloc.split('@')[-1].split(':')[0]
-            else:
-                return parsed.netloc.split(':')[0]
-        except:
-            try:
-                if '@' in proxy:
-                    return proxy.split('@')[-1].split(':')[0]
-                else:
-                    return proxy.split('://')[-1].split(':')[0]
-            except:
-                return proxy
+        return _parse_proxy_host(proxy)
     
     def mark_proxy_failed(self, proxy: str):
         """Loại bỏ proxy lỗi khỏi pool free (producer sẽ tiếp tục bổ sung)."""
         if not proxy:
             return
-        try:
-            if proxy:
-                proxy_ip = self.proxy_manager._parse_proxy_ip(proxy)
-                self.logger.error(f"Error fetching via Proxy IP: {proxy_ip}")
-            if proxy in self.free_proxies:
-                self.free_proxies = [p for p in self.free_proxies if p != proxy]
-        except Exception:
-            pass
+        proxy_ip = self._parse_proxy_ip(proxy)
+        self.logger.error("Error fetching via Proxy IP: %s", proxy_ip)
+        if proxy in self.free_proxies:
+            self.free_proxies = [p for p in self.free_proxies if p != proxy]
 
     def get_random_free_proxy(self) -> Optional[str]:
         """Chọn ngẫu nhiên proxy từ danh sách free_proxies (nếu có)."""
@@ -227,7 +288,7 @@ class ProxyManager:
                         if len(self.free_proxies) > Config.MAX_FREE_PROXIES:
                             self.free_proxies = self.free_proxies[-Config.MAX_FREE_PROXIES:]
         except Exception as e:
-            self.logger.debug(f"Error draining proxy queue: {e}")
+            self.logger.debug("Error draining proxy queue: %s", e)
 
     async def _consumer_loop(self):
         """Tiêu thụ proxy từ queue để duy trì pool free_proxies."""
@@ -341,96 +402,340 @@ class ProxyManager:
 class WebSocketManager:
     """Quản lý kết nối WebSocket"""
     
+    # Loại tin là snapshot đầy đủ: trong cùng một lần flush chỉ cần gửi bản mới nhất
+    SNAPSHOT_MESSAGE_TYPES = frozenset({'new_listings_update'})
+    
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # Mỗi kết nối có queue riêng + task writer, broadcast chỉ cần put_nowait
+        self.active_connections: Dict[WebSocket, Tuple[asyncio.Queue, asyncio.Task]] = {}
         self.logger = logging.getLogger("WebSocketManager")
     
     async def connect(self, websocket: WebSocket):
         """Kết nối WebSocket mới"""
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=Config.WS_QUEUE_SIZE)
+        self.active_connections[websocket] = (queue, asyncio.create_task(self._writer(websocket, queue)))
     
     def disconnect(self, websocket: WebSocket):
         """Ngắt kết nối WebSocket"""
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
+        if connection is not None and connection[1] is not asyncio.current_task():
+            connection[1].cancel()
     
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        """Gửi tin nhắn đến một WebSocket cụ thể"""
+    def _enqueue(self, websocket: WebSocket, message_type: str, message: str) -> bool:
+        """Đưa tin nhắn vào queue của một client, bỏ qua nếu queue đầy (client quá chậm)"""
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return False
         try:
-            await websocket.send_text(message)
+            connection[0].put_nowait((message_type, message))
+            return True
+        except asyncio.QueueFull:
+            self.logger.warning("Send queue full, dropping %s message", message_type)
+            return False
+    
+    def _coalesce(self, batch: List[tuple]) -> List[str]:
+        """Giữ nguyên thứ tự, bỏ các snapshot cũ đã bị snapshot mới hơn trong batch thay thế"""
+        latest = {message_type: index for index, (message_type, _) in enumerate(batch)
+                  if message_type in self.SNAPSHOT_MESSAGE_TYPES}
+        return [message for index, (message_type, message) in enumerate(batch)
+                if message_type not in latest or latest[message_type] == index]
+    
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        """Task gửi tin cho một client: lấy hết tin đang chờ rồi gửi trong một lần flush"""
+        try:
+            while True:
+                batch = [await queue.get()]
+                while len(batch) < Config.WS_BATCH_MAX:
+                    try:
+                        batch.append(queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                
+                for message in self._coalesce(batch):
+                    await asyncio.wait_for(websocket.send_text(message), timeout=Config.WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            self.logger.error(f"Error sending message: {e}")
+            self.logger.error("Error sending message: %r", e)
             self.disconnect(websocket)
+            # Đóng socket để vòng nhận của /ws kết thúc và client biết để kết nối lại
+            try:
+                await websocket.close(code=1011)
+            except Exception:
+                pass
     
-    async def broadcast(self, message: Dict[str, Any]):
+    def send_personal_message(self, message: str, websocket: WebSocket, message_type: str = 'personal'):
+        """Gửi tin nhắn đến một WebSocket cụ thể (qua queue để giữ đúng thứ tự với broadcast)"""
+        self._enqueue(websocket, message_type, message)
+    
+    def broadcast(self, message: Dict[str, Any]):
         """Gửi tin nhắn đến tất cả WebSocket đang kết nối"""
         if not self.active_connections:
             self.logger.warning("No active WebSocket connections to broadcast to")
             return
         
         try:
-            message_str = json.dumps(message, ensure_ascii=False)
+            message_str = json_dumps(message)
             message_type = message.get('type', 'unknown')
-            message_count = message.get('count', 0) if 'count' in message else (len(message.get('data', [])) if 'data' in message else 0)
-            # self.logger.info(f"Broadcasting {message_type} to {len(self.active_connections)} connection(s) with {message_count} items")
         except Exception as e:
             self.logger.error(f"Error serializing broadcast message: {e}")
             return
         
-        disconnected = []
-        
-        for connection in self.active_connections:
+        # Serialize một lần, chỉ put_nowait vào queue của từng client; writer task lo việc gửi
+        # Vòng lặp không await và không sửa active_connections nên duyệt trực tiếp, không cần copy
+        item = (message_type, message_str)
+        dropped = 0
+        for queue, _ in self.active_connections.values():
             try:
-                await connection.send_text(message_str)
-            except Exception as e:
-                self.logger.error(f"Error broadcasting to connection: {e}")
-                disconnected.append(connection)
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                dropped += 1
         
-        # Loại bỏ các kết nối bị lỗi
-        for connection in disconnected:
-            self.disconnect(connection)
+        if dropped:
+            self.logger.warning("Send queue full for %d connection(s), dropping %s message", dropped, message_type)
         
-        if disconnected:
-            self.logger.info(f"Removed {len(disconnected)} disconnected connections")
-        
-
 
 # =============================================================================
 # CRAWLER CLASS
 # =============================================================================
 
+# Script chứa dữ liệu Next.js, tìm bằng bytes.find thay vì regex hay dựng toàn bộ DOM
+_NEXT_DATA_MARKER = b'id="__NEXT_DATA__"'
+# Fallback khi regex không khớp (markup khác thường): chỉ dựng DOM cho đúng script này
+_NEXT_DATA_STRAINER = SoupStrainer('script', id='__NEXT_DATA__')
+
+# Selector class/attribute cho parser HTML fallback (compile một lần, BeautifulSoup gọi re.search)
+_SEARCH_RESULT_CLASS_RE = re.compile(r'search-result', re.IGNORECASE)
+_RESULT_TESTID_RE = re.compile(r'result', re.IGNORECASE)
+_LISTING_CLASS_RE = re.compile(r'item|listing|ad|result', re.IGNORECASE)
+_TITLE_CLASS_RE = re.compile(r'title', re.IGNORECASE)
+_PRICE_CLASS_RE = re.compile(r'price', re.IGNORECASE)
+_YEAR_CLASS_RE = re.compile(r'year', re.IGNORECASE)
+_KM_CLASS_RE = re.compile(r'km|mileage', re.IGNORECASE)
+
+# XPath tương đương các selector trên, chạy hoàn toàn trong libxml2 (chỉ khi có lxml)
+if lxml_etree is not None:
+    _XPATH_NS = {'re': 'http://exslt.org/regular-expressions'}
+    _XPATH_CONTAINER_SELECTORS = tuple(
+        lxml_etree.XPath(expr, namespaces=_XPATH_NS) for expr in (
+            "//div[re:test(@class, 'search-result', 'i')]",
+            "//div[re:test(@data-testid, 'result', 'i')]",
+            "//div[re:test(@class, 'item|listing|ad|result', 'i')]",
+        )
+    )
+    _XPATH_ADID = lxml_etree.XPath("(.//*[self::a or self::div][@data-adid])[1]/@data-adid")
+    _XPATH_TITLE = lxml_etree.XPath(
+        "(.//*[self::h2 or self::h3 or self::a][re:test(@class, 'title', 'i')])[1]", namespaces=_XPATH_NS)
+    _XPATH_PRICE = lxml_etree.XPath(
+        "(.//*[self::span or self::div][re:test(@class, 'price', 'i')])[1]", namespaces=_XPATH_NS)
+    _XPATH_YEAR = lxml_etree.XPath(
+        "(.//*[self::span or self::div][re:test(@class, 'year', 'i')])[1]", namespaces=_XPATH_NS)
+    _XPATH_KM = lxml_etree.XPath(
+        "(.//*[self::span or self::div][re:test(@class, 'km|mileage', 'i')])[1]", namespaces=_XPATH_NS)
+    _XPATH_LINK = lxml_etree.XPath("(.//a[@href])[1]/@href")
+    _XPATH_IMAGE = lxml_etree.XPath("(.//img[@src])[1]/@src")
+    # Text node như get_text() của BeautifulSoup: bỏ nội dung script/style (comment không phải text())
+    _XPATH_TEXT = lxml_etree.XPath(".//text()[not(ancestor::script or ancestor::style)]")
+
+
+# Hàm chuyển đổi values của attribute advert
+def _attr_first(values: List[Any]) -> Any:
+    return values[0]
+
+
+def _attr_flag(values: List[Any]) -> bool:
+    return values[0] == '1'
+
+
+def _attr_bool(values: List[Any]) -> bool:
+    return values[0].lower() == 'true'
+
+
+def _attr_all(values: List[Any]) -> List[Any]:
+    return values
+
+
+def _attr_logo_url(values: List[Any]) -> str:
+    return f"https://cache.willhaben.at/{values[0]}"
+
+
+def _attr_int(values: List[Any]) -> int:
+    return int(values[0]) if values[0].isdigit() else 0
+
+
+# Từ khóa nhận diện attribute chứa ảnh (so khớp trên tên đã upper một lần)
+_IMAGE_ATTRIBUTE_TOKENS = ('IMAGE', 'PHOTO', 'PICTURE')
+
+# Ánh xạ tên attribute của advert -> (nhóm trong car_model, field, hàm chuyển đổi values)
+# Tra cứu dict O(1) thay cho chuỗi if/elif dài cho mỗi attribute
+_ADVERT_ATTRIBUTES = {
+    # Thông tin xe
+    'CAR_MODEL/MAKE': ('car_info', 'make', _attr_first),
+    'CAR_MODEL/MODEL': ('car_info', 'model', _attr_first),
+    'CAR_MODEL/MODEL_SPECIFICATION': ('car_info', 'model_specification', _attr_first),
+    'YEAR_MODEL': ('car_info', 'year', _attr_first),
+    'MILEAGE': ('car_info', 'mileage', _attr_first),
+    'ENGINE/FUEL': ('car_info', 'fuel_type', _attr_first),
+    'ENGINE/FUEL_RESOLVED': ('car_info', 'fuel_type_resolved', _attr_first),
+    'TRANSMISSION': ('car_info', 'transmission', _attr_first),
+    'TRANSMISSION_RESOLVED': ('car_info', 'transmission_resolved', _attr_first),
+    'CONDITION': ('car_info', 'condition', _attr_first),
+    'CONDITION_RESOLVED': ('car_info', 'condition_resolved', _attr_first),
+    'CAR_TYPE': ('car_info', 'car_type', _attr_first),
+    'EXTERIORCOLOURMAIN': ('car_info', 'exterior_color', _attr_first),
+    'ENGINE/EFFECT': ('car_info', 'engine_power', _attr_first),
+    'NOOFSEATS': ('car_info', 'no_of_seats', _attr_first),
+    'WARRANTY': ('car_info', 'warranty', _attr_first),
+    'WARRANTY_RESOLVED': ('car_info', 'warranty_resolved', _attr_first),
+
+    # Thông tin giá cả
+    'PRICE': ('pricing', 'price', _attr_first),
+    'PRICE_FOR_DISPLAY': ('pricing', 'price_display', _attr_first),
+    'PRICE/AMOUNT': ('pricing', 'price_amount', _attr_first),
+    'ISPRIVATE': ('pricing', 'is_private', _attr_flag),
+    'MOTOR_PRICE_BONUS/TRADE_IN': ('pricing', 'motor_price_bonus_trade_in', _attr_bool),
+    'MOTOR_PRICE_BONUS/FINANCE': ('pricing', 'motor_price_bonus_finance', _attr_bool),
+
+    # Thông tin địa điểm
+    'ADDRESS': ('location', 'address', _attr_first),
+    'POSTCODE': ('location', 'postcode', _attr_first),
+    'LOCATION': ('location', 'city', _attr_first),
+    'STATE': ('location', 'state', _attr_first),
+    'COUNTRY': ('location', 'country', _attr_first),
+    'COORDINATES': ('location', 'coordinates', _attr_first),
+    'DISTRICT': ('location', 'district', _attr_first),
+
+    # Thông tin người bán
+    'ORGID': ('seller', 'org_id', _attr_first),
+    'ORGNAME': ('seller', 'org_name', _attr_first),
+    'ORG_UUID': ('seller', 'org_uuid', _attr_first),
+    'AUTDEALER': ('seller', 'is_autodealer', _attr_flag),
+    'AD_SEARCHRESULT_LOGO': ('seller', 'logo_url', _attr_logo_url),
+
+    # Thông tin thiết bị
+    'EQUIPMENT': ('equipment', 'equipment_ids', _attr_first),
+    'EQUIPMENT_RESOLVED': ('equipment', 'equipment_resolved', _attr_all),
+
+    # Thông tin thời gian
+    'PUBLISHED': ('timing', 'published', _attr_first),
+    'PUBLISHED_String': ('timing', 'published_string', _attr_first),
+    'LAST_UPDATED': ('timing', 'last_updated', _attr_first),
+    'IS_BUMPED': ('timing', 'is_bumped', _attr_flag),
+
+    # Thông tin bổ sung
+    'DEFECTS_LIABILITY': ('additional', 'defects_liability', _attr_flag),
+    'CONDITION_REPORT': ('additional', 'condition_report', _attr_flag),
+    'BODY_DYN': ('additional', 'body_dyn', _attr_first),
+    'SOURCE': ('additional', 'source', _attr_first),
+    'AD_UUID': ('additional', 'ad_uuid', _attr_first),
+    'fnmmocount': ('additional', 'fnmmocount', _attr_int),
+
+    # Thông tin cơ bản
+    'SEO_URL': (None, 'seo_url', _attr_first),
+}
+
+
+@dataclasses.dataclass
+class ListingSummary:
+    """Listing rút gọn gửi qua WebSocket (__slots__ thay cho dict cho mỗi listing)"""
+    
+    __slots__ = (
+        'id', 'title', 'price', 'year', 'mileage', 'fuel', 'brand', 'model', 'location',
+        'seller', 'url', 'image_url', 'crawled_at', 'source', 'transmission', 'last_updated'
+    )
+    
+    id: str
+    title: str
+    price: str
+    year: str
+    mileage: str
+    fuel: str
+    brand: str
+    model: str
+    location: str
+    seller: str
+    url: str
+    image_url: str
+    crawled_at: str
+    source: str
+    transmission: str
+    last_updated: str
+
+
+class RecentIdSet:
+    """Tập ID đã thấy có giới hạn: giữ max_size ID gần nhất, bỏ ID cũ nhất (FIFO)"""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._ids: Set[str] = set()
+        self._order: Deque[str] = deque()
+    
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self._ids
+    
+    def __len__(self) -> int:
+        return len(self._ids)
+    
+    def add(self, item_id: str):
+        """Thêm ID, loại bỏ ID cũ nhất nếu vượt giới hạn"""
+        if item_id in self._ids:
+            return
+        self._ids.add(item_id)
+        self._order.append(item_id)
+        if len(self._order) > self.max_size:
+            self._ids.discard(self._order.popleft())
+
+
 class WillhabenCrawler:
     """Crawler chính cho Willhaben.at"""
     
+    # Phần headers cố định, chỉ User-Agent thay đổi theo từng request
+    _BASE_HEADERS = MappingProxyType({
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'de-DE,de;q=0.9,en;q=0.8',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+        'Cache-Control': 'no-cache',
+        'Pragma': 'no-cache'
+    })
+    
     def __init__(self, websocket_manager: WebSocketManager):
         self.websocket_manager = websocket_manager
         self.proxy_manager = ProxyManager()
-        self.seen_ids: Set[str] = set()
+        self.seen_ids = RecentIdSet(Config.MAX_SEEN_IDS)
         self.all_listings: List[Dict[str, Any]] = []  # Lưu trữ tất cả listings đã crawl
-        self.new_listings_array: List[Dict[str, Any]] = []  # Array lưu new_listings để broadcast
+        self.new_listings_array: List[ListingSummary] = []  # Array lưu new_listings để broadcast
         self.total_crawled = 0
         self.session: Optional[aiohttp.ClientSession] = None
         self.user_agent = UserAgent()
+        # Tạo sẵn pool User-Agent, tránh gọi fake_useragent mỗi request
+        if Config.USER_AGENT_ROTATION:
+            self._ua_pool = tuple(self.user_agent.random for _ in range(Config.USER_AGENT_POOL_SIZE))
+        else:
+            self._ua_pool = (self.user_agent.chrome,)
         self.logger = logging.getLogger("WillhabenCrawler")
         self.is_running = False
+        self._stop_event: Optional[asyncio.Event] = None  # Tạo trong crawl_loop (cần event loop đang chạy)
         self.max_new_listings = 1000  # Giới hạn số lượng new_listings
+        self._crawl_timestamp: Optional[str] = None  # Timestamp dùng chung cho các listing trong một lần crawl
     
     async def create_session(self):
         """Tạo aiohttp session với cấu hình"""
         timeout = aiohttp.ClientTimeout(total=Config.REQUEST_TIMEOUT)
-        connector = aiohttp.TCPConnector(limit=100, limit_per_host=30)
+        connector = aiohttp.TCPConnector(
+            limit=Config.CONNECTION_LIMIT,
+            limit_per_host=Config.CONNECTION_LIMIT_PER_HOST,
+            ttl_dns_cache=Config.DNS_CACHE_TTL,
+            keepalive_timeout=Config.KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True
+        )
         
         self.session = aiohttp.ClientSession(
             timeout=timeout,
             connector=connector,
-            headers={
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'de-DE,de;q=0.9,en;q=0.8',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            }
+            headers=self._BASE_HEADERS
         )
     
     async def close_session(self):
@@ -440,19 +745,9 @@ class WillhabenCrawler:
     
     def get_random_headers(self) -> Dict[str, str]:
         """Tạo headers ngẫu nhiên để tránh detection"""
-        headers = {
-            'User-Agent': self.user_agent.random if Config.USER_AGENT_ROTATION else self.user_agent.chrome,
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'de-DE,de;q=0.9,en;q=0.8',
-            'Accept-Encoding': 'gzip, deflate',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Cache-Control': 'no-cache',
-            'Pragma': 'no-cache'
-        }
-        return headers
+        return {'User-Agent': random.choice(self._ua_pool), **self._BASE_HEADERS}
     
-    async def fetch_page(self, url: str,useProxy: bool = True) -> Optional[str]:
+    async def fetch_page(self, url: str,useProxy: bool = True) -> Optional[bytes]:
         """Fetch một trang web với proxy rotation"""
         if not self.session:
             await self.create_session()
@@ -465,7 +760,7 @@ class WillhabenCrawler:
             proxy = self.proxy_manager.get_random_proxy()
             if proxy:
                 proxy_ip = self.proxy_manager._parse_proxy_ip(proxy)
-                self.logger.info(f"Fetching data using Proxy IP: {proxy_ip} | Proxy URL: {proxy}")
+                self.logger.info("Fetching data using Proxy IP: %s | Proxy URL: %s", proxy_ip, proxy)
         elif useProxy:
             # Chọn proxy free từ danh sách nền (nếu có); nếu rỗng thì không dùng proxy
             proxy = self.proxy_manager.get_random_free_proxy()
@@ -474,10 +769,10 @@ class WillhabenCrawler:
                 pool_size = len(self.proxy_manager.free_proxies)
             except Exception:
                 pool_size = 0
-            self.logger.info(f"Free proxy pool size: {pool_size} | Mode: {'proxy' if proxy else 'None'}")
+            self.logger.info("Free proxy pool size: %d | Mode: %s", pool_size, 'proxy' if proxy else 'None')
             if proxy:
                 proxy_ip = self.proxy_manager._parse_proxy_ip(proxy)
-                self.logger.info(f"Fetching data using Free Proxy IP: {proxy_ip} | Proxy URL: {proxy}")
+                self.logger.info("Fetching data using Free Proxy IP: %s | Proxy URL: %s", proxy_ip, proxy)
         
         try:
             
@@ -486,7 +781,8 @@ class WillhabenCrawler:
             
             async with self.session.get(url, headers=headers, proxy=proxy, timeout=timeout) as response:
                 if response.status == 200:
-                    content = await response.text()
+                    # Trả về bytes thô, parser JSON/HTML tự xử lý, tránh decode toàn trang
+                    content = await response.read()
                     # if proxy:
                     #     proxy_ip = self.proxy_manager._parse_proxy_ip(proxy)
                     #     self.logger.info(f"Successfully fetched data via Proxy IP: {proxy_ip} | URL: {url}")
@@ -514,25 +810,34 @@ class WillhabenCrawler:
             
             return await self.fetch_page(url,useProxy=False)
     
-    def parse_car_listings(self, html: str) -> List[Dict[str, Any]]:
+    def parse_car_listings(self, html: bytes) -> List[Dict[str, Any]]:
         """Parse HTML để trích xuất thông tin xe"""
-        soup = BeautifulSoup(html, 'html.parser')  # Sử dụng html.parser thay vì lxml
+        # Đường fallback (ít dùng): decode một lần để lxml/BeautifulSoup không phải đoán encoding
+        if isinstance(html, bytes):
+            html = html.decode('utf-8', errors='replace')
+        
+        if lxml_html is not None:
+            try:
+                return self.parse_car_listings_lxml(html)
+            except Exception as e:
+                # Fallback về BeautifulSoup nếu lxml không xử lý được
+                self.logger.debug("lxml fast path failed, fallback to BeautifulSoup: %s", e)
+        
+        soup = BeautifulSoup(html, HTML_PARSER)
         listings = []
         
         try:
             # Tìm các container chứa thông tin xe
             # Cấu trúc có thể thay đổi, cần điều chỉnh theo thực tế
-            car_containers = soup.find_all('div', class_=lambda x: x and 'search-result' in x.lower())
+            car_containers = soup.find_all('div', class_=_SEARCH_RESULT_CLASS_RE)
             
             if not car_containers:
                 # Thử các selector khác
-                car_containers = soup.find_all('div', {'data-testid': lambda x: x and 'result' in x.lower()})
+                car_containers = soup.find_all('div', {'data-testid': _RESULT_TESTID_RE})
             
             if not car_containers:
                 # Fallback: tìm tất cả div có chứa thông tin xe
-                car_containers = soup.find_all('div', class_=lambda x: x and any(
-                    keyword in x.lower() for keyword in ['item', 'listing', 'ad', 'result']
-                ))
+                car_containers = soup.find_all('div', class_=_LISTING_CLASS_RE)
             
             
             for container in car_containers:
@@ -541,7 +846,7 @@ class WillhabenCrawler:
                     if listing and listing.get('id'):
                         listings.append(listing)
                 except Exception as e:
-                    self.logger.debug(f"Error parsing container: {e}")
+                    self.logger.debug("Error parsing container: %s", e)
                     continue
             
         except Exception as e:
@@ -549,21 +854,59 @@ class WillhabenCrawler:
         
         return listings
     
-    def parse_next_data(self, html: str) -> List[Dict[str, Any]]:
+    def parse_car_listings_lxml(self, html: str) -> List[Dict[str, Any]]:
+        """Parse HTML bằng lxml + XPath (selector chạy trong C, không qua BeautifulSoup)"""
+        root = lxml_html.fromstring(html)
+        listings = []
+        
+        # Cùng thứ tự fallback selector như parse_car_listings
+        car_containers = []
+        for selector in _XPATH_CONTAINER_SELECTORS:
+            car_containers = selector(root)
+            if car_containers:
+                break
+        
+        for container in car_containers:
+            try:
+                listing = self.extract_car_info_lxml(container)
+                if listing and listing.get('id'):
+                    listings.append(listing)
+            except Exception as e:
+                self.logger.debug("Error parsing container: %s", e)
+                continue
+        
+        return listings
+    
+    def find_next_data_payload(self, html: bytes) -> Optional[bytes]:
+        """Lấy nội dung JSON của script __NEXT_DATA__ (bytes.find trước, SoupStrainer sau)"""
+        marker = html.find(_NEXT_DATA_MARKER)
+        # Marker phải nằm trong thẻ <script ...> đang mở
+        if marker != -1 and html.rfind(b'<script', 0, marker) > html.rfind(b'>', 0, marker):
+            start = html.find(b'>', marker) + 1
+            end = html.find(b'</script>', start)
+            if start and end != -1 and html[start:end].strip():
+                return html[start:end]
+        
+        soup = BeautifulSoup(html, HTML_PARSER, parse_only=_NEXT_DATA_STRAINER)
+        script = soup.script
+        if script and script.string and script.string.strip():
+            return script.string.encode('utf-8')
+        return None
+    
+    def parse_next_data(self, html: bytes) -> List[Dict[str, Any]]:
         """Parse dữ liệu từ __NEXT_DATA__ script tag"""
-        soup = BeautifulSoup(html, 'html.parser')
         listings = []
         
         try:
             # Tìm script tag chứa __NEXT_DATA__
-            next_data_script = soup.find('script', id='__NEXT_DATA__')
+            payload = self.find_next_data_payload(html)
             
-            if not next_data_script or not next_data_script.string:
+            if not payload:
                 self.logger.warning("Không tìm thấy __NEXT_DATA__ script")
                 return listings
             
             # Parse JSON data
-            json_data = json.loads(next_data_script.string)
+            json_data = json_loads(payload)
             
             # Trích xuất dữ liệu xe từ advertSummaryList
             try:
@@ -577,7 +920,7 @@ class WillhabenCrawler:
                             #self.log_advert_to_file(advert, car_model)
                             listings.append(car_model)
                     except Exception as e:
-                        self.logger.debug(f"Lỗi khi parse advert: {e}")
+                        self.logger.debug("Lỗi khi parse advert: %s", e)
                         continue
                         
             except KeyError as e:
@@ -612,8 +955,8 @@ class WillhabenCrawler:
             }
             
             # Ghi vào file JSON
-            with open(log_filename, 'w', encoding='utf-8') as f:
-                json.dump(log_data, f, ensure_ascii=False, indent=2)
+            with open(log_filename, 'wb') as f:
+                f.write(json_dumps_pretty(log_data))
             
             
             # Cập nhật file tổng hợp
@@ -632,8 +975,8 @@ class WillhabenCrawler:
             summary_data = []
             if os.path.exists(summary_file):
                 try:
-                    with open(summary_file, 'r', encoding='utf-8') as f:
-                        summary_data = json.load(f)
+                    with open(summary_file, 'rb') as f:
+                        summary_data = json_loads(f.read())
                 except (json.JSONDecodeError, FileNotFoundError):
                     summary_data = []
             
@@ -671,8 +1014,8 @@ class WillhabenCrawler:
                 summary_data.append(advert_entry)
             
             # Ghi lại file tổng hợp
-            with open(summary_file, 'w', encoding='utf-8') as f:
-                json.dump(summary_data, f, ensure_ascii=False, indent=2)
+            with open(summary_file, 'wb') as f:
+                f.write(json_dumps_pretty(summary_data))
             
         except Exception as e:
             self.logger.error(f"Lỗi khi cập nhật summary log: {e}")
@@ -687,7 +1030,7 @@ class WillhabenCrawler:
                 'title': advert.get('description', ''),
                 'url': advert.get('selfLink', ''),
                 'seo_url': '',
-                'crawled_at': datetime.now().isoformat(),
+                'crawled_at': self.get_crawl_timestamp(),
                 
                 # Thông tin trạng thái
                 'status': {
@@ -791,120 +1134,15 @@ class WillhabenCrawler:
                 attributes = advert['attributes'].get('attribute', [])
                 for attr in attributes:
                     if 'name' in attr and 'values' in attr and attr['values']:
-                        attr_name = attr['name']
-                        attr_value = attr['values'][0] if attr['values'] else ''
-                        
-                        # Thông tin xe
-                        if attr_name == 'CAR_MODEL/MAKE':
-                            car_model['car_info']['make'] = attr_value
-                        elif attr_name == 'CAR_MODEL/MODEL':
-                            car_model['car_info']['model'] = attr_value
-                        elif attr_name == 'CAR_MODEL/MODEL_SPECIFICATION':
-                            car_model['car_info']['model_specification'] = attr_value
-                        elif attr_name == 'YEAR_MODEL':
-                            car_model['car_info']['year'] = attr_value
-                        elif attr_name == 'MILEAGE':
-                            car_model['car_info']['mileage'] = attr_value
-                        elif attr_name == 'ENGINE/FUEL':
-                            car_model['car_info']['fuel_type'] = attr_value
-                        elif attr_name == 'ENGINE/FUEL_RESOLVED':
-                            car_model['car_info']['fuel_type_resolved'] = attr_value
-                        elif attr_name == 'TRANSMISSION':
-                            car_model['car_info']['transmission'] = attr_value
-                        elif attr_name == 'TRANSMISSION_RESOLVED':
-                            car_model['car_info']['transmission_resolved'] = attr_value
-                        elif attr_name == 'CONDITION':
-                            car_model['car_info']['condition'] = attr_value
-                        elif attr_name == 'CONDITION_RESOLVED':
-                            car_model['car_info']['condition_resolved'] = attr_value
-                        elif attr_name == 'CAR_TYPE':
-                            car_model['car_info']['car_type'] = attr_value
-                        elif attr_name == 'EXTERIORCOLOURMAIN':
-                            car_model['car_info']['exterior_color'] = attr_value
-                        elif attr_name == 'ENGINE/EFFECT':
-                            car_model['car_info']['engine_power'] = attr_value
-                        elif attr_name == 'NOOFSEATS':
-                            car_model['car_info']['no_of_seats'] = attr_value
-                        elif attr_name == 'WARRANTY':
-                            car_model['car_info']['warranty'] = attr_value
-                        elif attr_name == 'WARRANTY_RESOLVED':
-                            car_model['car_info']['warranty_resolved'] = attr_value
-                        
-                        # Thông tin giá cả
-                        elif attr_name == 'PRICE':
-                            car_model['pricing']['price'] = attr_value
-                        elif attr_name == 'PRICE_FOR_DISPLAY':
-                            car_model['pricing']['price_display'] = attr_value
-                        elif attr_name == 'PRICE/AMOUNT':
-                            car_model['pricing']['price_amount'] = attr_value
-                        elif attr_name == 'ISPRIVATE':
-                            car_model['pricing']['is_private'] = attr_value == '1'
-                        elif attr_name == 'MOTOR_PRICE_BONUS/TRADE_IN':
-                            car_model['pricing']['motor_price_bonus_trade_in'] = attr_value.lower() == 'true'
-                        elif attr_name == 'MOTOR_PRICE_BONUS/FINANCE':
-                            car_model['pricing']['motor_price_bonus_finance'] = attr_value.lower() == 'true'
-                        
-                        # Thông tin địa điểm
-                        elif attr_name == 'ADDRESS':
-                            car_model['location']['address'] = attr_value
-                        elif attr_name == 'POSTCODE':
-                            car_model['location']['postcode'] = attr_value
-                        elif attr_name == 'LOCATION':
-                            car_model['location']['city'] = attr_value
-                        elif attr_name == 'STATE':
-                            car_model['location']['state'] = attr_value
-                        elif attr_name == 'COUNTRY':
-                            car_model['location']['country'] = attr_value
-                        elif attr_name == 'COORDINATES':
-                            car_model['location']['coordinates'] = attr_value
-                        elif attr_name == 'DISTRICT':
-                            car_model['location']['district'] = attr_value
-                        
-                        # Thông tin người bán
-                        elif attr_name == 'ORGID':
-                            car_model['seller']['org_id'] = attr_value
-                        elif attr_name == 'ORGNAME':
-                            car_model['seller']['org_name'] = attr_value
-                        elif attr_name == 'ORG_UUID':
-                            car_model['seller']['org_uuid'] = attr_value
-                        elif attr_name == 'ISPRIVATE':
-                            car_model['seller']['is_private'] = attr_value == '1'
-                        elif attr_name == 'AUTDEALER':
-                            car_model['seller']['is_autodealer'] = attr_value == '1'
-                        elif attr_name == 'AD_SEARCHRESULT_LOGO':
-                            car_model['seller']['logo_url'] = f"https://cache.willhaben.at/{attr_value}"
-                        
-                        # Thông tin thiết bị
-                        elif attr_name == 'EQUIPMENT':
-                            car_model['equipment']['equipment_ids'] = attr_value
-                        elif attr_name == 'EQUIPMENT_RESOLVED':
-                            car_model['equipment']['equipment_resolved'] = attr['values']
-                        
-                        # Thông tin thời gian
-                        elif attr_name == 'PUBLISHED':
-                            car_model['timing']['published'] = attr_value
-                        elif attr_name == 'PUBLISHED_String':
-                            car_model['timing']['published_string'] = attr_value
-                        elif attr_name == 'LAST_UPDATED':
-                            car_model['timing']['last_updated'] = attr_value
-                        elif attr_name == 'IS_BUMPED':
-                            car_model['timing']['is_bumped'] = attr_value == '1'
-                        
-                        # Thông tin bổ sung
-                        elif attr_name == 'DEFECTS_LIABILITY':
-                            car_model['additional']['defects_liability'] = attr_value == '1'
-                        elif attr_name == 'CONDITION_REPORT':
-                            car_model['additional']['condition_report'] = attr_value == '1'
-                        elif attr_name == 'BODY_DYN':
-                            car_model['additional']['body_dyn'] = attr_value
-                        elif attr_name == 'SOURCE':
-                            car_model['additional']['source'] = attr_value
-                        elif attr_name == 'AD_UUID':
-                            car_model['additional']['ad_uuid'] = attr_value
-                        elif attr_name == 'fnmmocount':
-                            car_model['additional']['fnmmocount'] = int(attr_value) if attr_value.isdigit() else 0
-                        elif attr_name == 'SEO_URL':
-                            car_model['seo_url'] = attr_value
+                        target = _ADVERT_ATTRIBUTES.get(attr['name'])
+                        if target is None:
+                            continue
+                        section, field, convert = target
+                        value = convert(attr['values'])
+                        if section is None:
+                            car_model[field] = value
+                        else:
+                            car_model[section][field] = value
             
             # Trích xuất thông tin hình ảnh
             if 'advertImageList' in advert and 'advertImage' in advert['advertImageList']:
@@ -933,8 +1171,8 @@ class WillhabenCrawler:
                     attributes = advert['attributes'].get('attribute', [])
                     for attr in attributes:
                         if 'name' in attr and 'values' in attr and attr['values']:
-                            attr_name = attr['name']
-                            if 'IMAGE' in attr_name.upper() or 'PHOTO' in attr_name.upper() or 'PICTURE' in attr_name.upper():
+                            attr_name = attr['name'].upper()
+                            if any(token in attr_name for token in _IMAGE_ATTRIBUTE_TOKENS):
                                 attr_value = attr['values'][0] if attr['values'] else ''
                                 if attr_value:
                                     car_model['images']['main_image'] = attr_value
@@ -968,19 +1206,19 @@ class WillhabenCrawler:
                 return None
             
             # Trích xuất thông tin cơ bản
-            title_element = container.find(['h2', 'h3', 'a'], class_=lambda x: x and 'title' in x.lower())
+            title_element = container.find(['h2', 'h3', 'a'], class_=_TITLE_CLASS_RE)
             title = title_element.get_text(strip=True) if title_element else "N/A"
             
             # Tìm giá
-            price_element = container.find(['span', 'div'], class_=lambda x: x and 'price' in x.lower())
+            price_element = container.find(['span', 'div'], class_=_PRICE_CLASS_RE)
             price = price_element.get_text(strip=True) if price_element else "N/A"
             
             # Tìm năm sản xuất
-            year_element = container.find(['span', 'div'], class_=lambda x: x and 'year' in x.lower())
+            year_element = container.find(['span', 'div'], class_=_YEAR_CLASS_RE)
             year = year_element.get_text(strip=True) if year_element else "N/A"
             
             # Tìm kilomet
-            km_element = container.find(['span', 'div'], class_=lambda x: x and ('km' in x.lower() or 'mileage' in x.lower()))
+            km_element = container.find(['span', 'div'], class_=_KM_CLASS_RE)
             km = km_element.get_text(strip=True) if km_element else "N/A"
             
             # Tìm link chi tiết
@@ -991,54 +1229,117 @@ class WillhabenCrawler:
             img_element = container.find('img', src=True)
             image_url = img_element['src'] if img_element else None
             
-            return {
-                'id': str(listing_id),
-                'title': title,
-                'price': price,
-                'year': year,
-                'km': km,
-                'link': link,
-                'image_url': image_url,
-                'crawled_at': datetime.now().isoformat(),
-                'source': 'willhaben.at'
-            }
+            return self.build_car_info(listing_id, title, price, year, km, link, image_url)
             
         except Exception as e:
-            self.logger.debug(f"Error extracting car info: {e}")
+            self.logger.debug("Error extracting car info: %s", e)
+            return None
+    
+    def extract_car_info_lxml(self, container) -> Optional[Dict[str, Any]]:
+        """Trích xuất thông tin xe từ một container lxml (tương đương extract_car_info)"""
+        listing_id = container.get('data-adid') or container.get('id')
+        if not listing_id:
+            # Tìm trong các thẻ con
+            id_values = _XPATH_ADID(container)
+            listing_id = id_values[0] if id_values else None
+        
+        if not listing_id:
             return None
+        
+        def first_text(xpath) -> str:
+            elements = xpath(container)
+            if not elements:
+                return "N/A"
+            # Giống get_text(strip=True) của BeautifulSoup
+            return ''.join(text.strip() for text in _XPATH_TEXT(elements[0]))
+        
+        links = _XPATH_LINK(container)
+        images = _XPATH_IMAGE(container)
+        
+        return self.build_car_info(
+            listing_id,
+            first_text(_XPATH_TITLE),
+            first_text(_XPATH_PRICE),
+            first_text(_XPATH_YEAR),
+            first_text(_XPATH_KM),
+            urljoin(Config.BASE_URL, links[0]) if links else None,
+            images[0] if images else None
+        )
+    
+    def build_car_info(self, listing_id: Any, title: str, price: str, year: str, km: str,
+                       link: Optional[str], image_url: Optional[str]) -> Dict[str, Any]:
+        """Tạo dict listing từ các field đã trích xuất bằng HTML parser"""
+        return {
+            'id': str(listing_id),
+            'title': title,
+            'price': price,
+            'year': year,
+            'km': km,
+            'link': link,
+            'image_url': image_url,
+            'crawled_at': self.get_crawl_timestamp(),
+            'source': 'willhaben.at'
+        }
+    
+    def get_crawl_timestamp(self) -> str:
+        """Timestamp của lần crawl hiện tại (tính một lần thay vì mỗi listing)"""
+        return self._crawl_timestamp or datetime.now().isoformat()
+    
+    def get_crawl_urls(self) -> List[str]:
+        """Danh sách URL các trang kết quả cần crawl"""
+        urls = [Config.BASE_URL]
+        for page in range(2, Config.CRAWL_PAGES + 1):
+            urls.append(f"{Config.BASE_URL}?page={page}")
+        return urls
+    
+    async def _bounded_fetch(self, semaphore: asyncio.Semaphore, url: str) -> Optional[bytes]:
+        """Fetch một trang, giới hạn số request song song bằng semaphore"""
+        async with semaphore:
+            return await self.fetch_page(url)
     
     async def crawl_once(self) -> List[Dict[str, Any]]:
         """Thực hiện một lần crawl"""
-        html = await self.fetch_page(Config.BASE_URL)
-        if not html:
-            return []
-        
-        # Thử parse từ __NEXT_DATA__ trước (phương pháp mới)
-        listings = self.parse_next_data(html)
+        semaphore = asyncio.Semaphore(Config.FETCH_CONCURRENCY)
+        pages = await asyncio.gather(
+            *(self._bounded_fetch(semaphore, url) for url in self.get_crawl_urls()),
+            return_exceptions=True
+        )
         
-        # Nếu không có dữ liệu từ __NEXT_DATA__, fallback về phương pháp cũ
-        if not listings:
-            listings = self.parse_car_listings(html)
+        # Dùng chung một timestamp cho mọi listing parse trong lần crawl này
+        self._crawl_timestamp = datetime.now().isoformat()
+        listings = []
+        try:
+            for html in pages:
+                if isinstance(html, BaseException):
+                    self.logger.error("Error fetching page: %s", html)
+                    continue
+                if not html:
+                    continue
+                
+                # Thử parse từ __NEXT_DATA__ trước (phương pháp mới)
+                page_listings = self.parse_next_data(html)
+                
+                # Nếu không có dữ liệu từ __NEXT_DATA__, fallback về phương pháp cũ
+                if not page_listings:
+                    page_listings = self.parse_car_listings(html)
+                
+                listings.extend(page_listings)
+        finally:
+            self._crawl_timestamp = None
         
-        # Phát hiện tin mới
+        # Phát hiện tin mới (giữ thứ tự trên trang, ID trùng trong cùng lần crawl chỉ lấy một lần)
         new_listings = []
         for listing in listings:
-            if listing['id'] not in self.seen_ids:
-                self.seen_ids.add(listing['id'])
+            listing_id = listing['id']
+            if listing_id not in self.seen_ids:
+                self.seen_ids.add(listing_id)
                 new_listings.append(listing)
-                # Thêm vào đầu danh sách all_listings (item mới nhất ở đầu)
-                self.all_listings.insert(0, listing)
-                # Giới hạn số lượng listings để tránh tốn bộ nhớ (giữ lại 1000 item mới nhất)
-                if len(self.all_listings) > 1000:
-                    self.all_listings = self.all_listings[:1000]
-                # Log thông tin chi tiết hơn
-                car_info = listing.get('car_info', {})
-                pricing = listing.get('pricing', {})
-                price_display = pricing.get('price_display', pricing.get('price', 'N/A'))
-                make = car_info.get('make', 'N/A')
-                model = car_info.get('model', 'N/A')
-                year = car_info.get('year', 'N/A')
-                # self.logger.info(f"New listing found: {make} {model} ({year}) - {price_display}")
+        
+        if new_listings:
+            # Thêm một lần vào đầu all_listings (item mới nhất ở đầu)
+            self.all_listings[:0] = reversed(new_listings)
+            # Giới hạn số lượng listings để tránh tốn bộ nhớ (giữ lại 1000 item mới nhất)
+            del self.all_listings[1000:]
         
         self.total_crawled += len(listings)
         
@@ -1047,8 +1348,11 @@ class WillhabenCrawler:
     async def crawl_loop(self):
         """Vòng lặp crawl chính"""
         self.is_running = True
+        self._stop_event = asyncio.Event()
         
         while self.is_running:
+            # Hạn của chu kỳ này (tính từ lúc bắt đầu crawl), random delay để tránh bị chặn
+            deadline = time.monotonic() + Config.CRAWL_INTERVAL + random.uniform(Config.MIN_DELAY, Config.MAX_DELAY)
             try:
                 # Thực hiện crawl
                 new_listings = await self.crawl_once()
@@ -1059,14 +1363,8 @@ class WillhabenCrawler:
                     
                     # Log thông tin của new_listings_array
                     if self.new_listings_array:
-                        self.logger.info(f"new_listings_array hiện có {len(self.new_listings_array)} items:")
-                        for i, item in enumerate(self.new_listings_array[:10], 1):  # Log 10 items đầu tiên
-                            item_id = item.get('id', 'N/A')
-                            item_title = item.get('title', 'N/A')
-                            # self.logger.info(f"  [{i}] ID: {item_id} | Title: {item_title}")
-                        # if len(self.new_listings_array) > 10:
-                            # self.logger.info(f"  ... và {len(self.new_listings_array) - 10} items khác")
-                    
+                        self.logger.info("new_listings_array hiện có %d items", len(self.new_listings_array))
+
                     # Broadcast toàn bộ array cho WebSocket
                     broadcast_data = {
                         'type': 'new_listings_update',
@@ -1075,15 +1373,21 @@ class WillhabenCrawler:
                         'count': len(self.new_listings_array)
                     }
                     # self.logger.info(f"Broadcasting new_listings_update with {len(self.new_listings_array)} items")
-                    await self.websocket_manager.broadcast(broadcast_data)
+                    self.websocket_manager.broadcast(broadcast_data)
                 
-                # Random delay để tránh bị chặn
-                delay = random.uniform(Config.MIN_DELAY, Config.MAX_DELAY)
-                await asyncio.sleep(Config.CRAWL_INTERVAL + delay)
+                # Chỉ ngủ phần thời gian còn lại của chu kỳ, không cộng dồn thời gian crawl
+                await self._wait_for_stop(deadline - time.monotonic())
                 
             except Exception as e:
                 self.logger.error(f"Error in crawl loop: {e}")
-                await asyncio.sleep(Config.CRAWL_INTERVAL)
+                await self._wait_for_stop(Config.CRAWL_INTERVAL)
+    
+    async def _wait_for_stop(self, timeout: float):
+        """Ngủ tối đa timeout giây, thức dậy ngay khi stop() được gọi"""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout=max(0.0, timeout))
+        except asyncio.TimeoutError:
+            pass
     
     def update_new_listings_array(self, new_listings: List[Dict[str, Any]]):
         """Cập nhật new_listings array: thêm mới vào đầu, loại bỏ duplicate dựa trên ID"""
@@ -1091,7 +1395,7 @@ class WillhabenCrawler:
             return
         
         # Lấy danh sách ID hiện tại để kiểm tra duplicate
-        existing_ids = {listing.get('id', '') for listing in self.new_listings_array}
+        existing_ids = {listing.id for listing in self.new_listings_array}
         
         # Convert các listing mới và thêm vào đầu danh sách
         for listing in new_listings:
@@ -1102,7 +1406,7 @@ class WillhabenCrawler:
                 # Remove item cũ có cùng ID
                 self.new_listings_array = [
                     item for item in self.new_listings_array 
-                    if item.get('id', '') != listing_id
+                    if item.id != listing_id
                 ]
             
             # Convert listing sang format WebSocket
@@ -1119,8 +1423,10 @@ class WillhabenCrawler:
     def stop(self):
         """Dừng crawler"""
         self.is_running = False
+        if self._stop_event is not None:
+            self._stop_event.set()
     
-    def convert_car_model_for_websocket(self, car_model: Dict[str, Any]) -> Dict[str, Any]:
+    def convert_car_model_for_websocket(self, car_model: Dict[str, Any]) -> ListingSummary:
         """Chuyển đổi car_model phức tạp thành format đơn giản cho WebSocket"""
         try:
             # Lấy thông tin từ car_model nested structure
@@ -1152,45 +1458,45 @@ class WillhabenCrawler:
                 elif not isinstance(last_updated, str):
                     last_updated = str(last_updated)
             
-            return {
-                'id': car_model.get('id', ''),
-                'title': car_model.get('title', ''),
-                'price': pricing.get('price_display', pricing.get('price', '')),
-                'year': car_info.get('year', ''),
-                'mileage': car_info.get('mileage', ''),
-                'fuel': car_info.get('fuel_type_resolved', car_info.get('fuel_type', '')),
-                'brand': car_info.get('make', ''),
-                'model': car_info.get('model', ''),
-                'location': location.get('city', location.get('address', '')),
-                'seller': seller.get('org_name', ''),
-                'url': car_model.get('url', ''),
-                'image_url': image_url,
-                'crawled_at': crawled_at,
-                'source': 'willhaben.at',
-                'transmission': car_info.get('transmission_resolved', car_info.get('transmission', '')),
-                'last_updated': last_updated
-            }
+            return ListingSummary(
+                id=car_model.get('id', ''),
+                title=car_model.get('title', ''),
+                price=pricing.get('price_display', pricing.get('price', '')),
+                year=car_info.get('year', ''),
+                mileage=car_info.get('mileage', ''),
+                fuel=car_info.get('fuel_type_resolved', car_info.get('fuel_type', '')),
+                brand=car_info.get('make', ''),
+                model=car_info.get('model', ''),
+                location=location.get('city', location.get('address', '')),
+                seller=seller.get('org_name', ''),
+                url=car_model.get('url', ''),
+                image_url=image_url,
+                crawled_at=crawled_at,
+                source='willhaben.at',
+                transmission=car_info.get('transmission_resolved', car_info.get('transmission', '')),
+                last_updated=last_updated
+            )
         except Exception as e:
             self.logger.error(f"Lỗi khi convert car_model cho WebSocket: {e}")
             # Fallback về format cơ bản
-            return {
-                'id': car_model.get('id', ''),
-                'title': car_model.get('title', ''),
-                'price': 'N/A',
-                'year': 'N/A',
-                'mileage': 'N/A',
-                'fuel': 'N/A',
-                'brand': 'N/A',
-                'model': 'N/A',
-                'location': 'N/A',
-                'seller': 'N/A',
-                'url': car_model.get('url', ''),
-                'image_url': '',
-                'crawled_at': car_model.get('crawled_at', ''),
-                'source': 'willhaben.at',
-                'transmission': 'N/A',
-                'last_updated': ''
-            }
+            return ListingSummary(
+                id=car_model.get('id', ''),
+                title=car_model.get('title', ''),
+                price='N/A',
+                year='N/A',
+                mileage='N/A',
+                fuel='N/A',
+                brand='N/A',
+                model='N/A',
+                location='N/A',
+                seller='N/A',
+                url=car_model.get('url', ''),
+                image_url='',
+                crawled_at=car_model.get('crawled_at', ''),
+                source='willhaben.at',
+                transmission='N/A',
+                last_updated=''
+            )
 
 
 # =============================================================================
@@ -1247,10 +1553,9 @@ async def root():
         }
     }
 
-@app.get("/test", response_class=HTMLResponse)
-async def test_page():
-    """Trang test WebSocket"""
-    html_content = """
+
+# Trang test WebSocket: encode và tính ETag một lần khi import thay vì mỗi request
+TEST_PAGE_HTML = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -1357,7 +1662,7 @@ async def test_page():
                             // Nhận array và hiển thị trực tiếp
                             if (data.data && Array.isArray(data.data)) {
                                 console.log(`Received ${data.type}: ${data.data.length} items`);
-                                displayListings(data.data);
+                                scheduleDisplayListings(data.data);
                             } else {
                                 console.warn('Invalid data format:', data);
                             }
@@ -1402,13 +1707,11 @@ async def test_page():
                 
                 console.log(`displayListings: Rendering ${listings.length} listings`);
                 
-                // Xóa danh sách cũ
-                messagesDiv.innerHTML = '';
+                // Dựng toàn bộ danh sách trong DocumentFragment, chỉ chèn vào DOM một lần (một lần reflow)
+                const fragment = document.createDocumentFragment();
                 
-                // listings từ server có mới nhất ở đầu (index 0)
-                // Để hiển thị cũ nhất ở trên, mới nhất ở dưới:
-                // Duyệt từ cuối array về đầu và thêm vào đầu DOM
-                for (let i = listings.length - 1; i >= 0 ; i--) {
+                // listings từ server có mới nhất ở đầu (index 0), giữ nguyên thứ tự đó trong DOM
+                for (let i = 0; i < listings.length; i++) {
                     const listing = listings[i];
                     if (!listing || !listing.id) {
                         console.warn('Skipping invalid listing:', listing);
@@ -1445,15 +1748,32 @@ async def test_page():
                         </div>
                     `;
                     
-                    // Thêm vào đầu danh sách (cũ nhất sẽ ở trên)
-                    messagesDiv.insertBefore(listingDiv, messagesDiv.firstChild);
+                    fragment.appendChild(listingDiv);
                 }
                 
-                console.log(`displayListings: Rendered ${messagesDiv.children.length} items in DOM`);
+                // Giới hạn số lượng tin hiển thị (giữ lại 50 tin ở cuối), cắt trước khi chèn vào DOM
+                while (fragment.children.length > 50) {
+                    fragment.removeChild(fragment.firstChild);
+                }
                 
-                // Giới hạn số lượng tin hiển thị (giữ lại 50 tin mới nhất ở cuối)
-                while (messagesDiv.children.length > 50) {
-                    messagesDiv.removeChild(messagesDiv.firstChild);
+                // Thay danh sách cũ bằng danh sách mới
+                messagesDiv.innerHTML = '';
+                messagesDiv.appendChild(fragment);
+                
+                console.log(`displayListings: Rendered ${messagesDiv.children.length} items in DOM`);
+            }
+            
+            // Gộp các snapshot đến trong cùng một frame, chỉ render snapshot mới nhất
+            let pendingListings = null;
+            function scheduleDisplayListings(listings) {
+                const scheduled = pendingListings !== null;
+                pendingListings = listings;
+                if (!scheduled) {
+                    requestAnimationFrame(function() {
+                        const latest = pendingListings;
+                        pendingListings = null;
+                        displayListings(latest);
+                    });
                 }
             }
 
@@ -1464,7 +1784,20 @@ async def test_page():
     </body>
     </html>
     """
-    return html_content
+_TEST_PAGE_BYTES = TEST_PAGE_HTML.encode('utf-8')
+_TEST_PAGE_HEADERS = {
+    'ETag': f'"{hashlib.md5(_TEST_PAGE_BYTES).hexdigest()}"',
+    'Cache-Control': 'public, max-age=60',
+}
+
+
+@app.get("/test", response_class=HTMLResponse)
+async def test_page(request: Request):
+    """Trang test WebSocket"""
+    # Trình duyệt đã có bản mới nhất -> 304, không gửi lại nội dung
+    if request.headers.get('if-none-match') == _TEST_PAGE_HEADERS['ETag']:
+        return Response(status_code=304, headers=_TEST_PAGE_HEADERS)
+    return HTMLResponse(content=_TEST_PAGE_BYTES, headers=_TEST_PAGE_HEADERS)
 
 
 @app.websocket("/ws")
@@ -1474,13 +1807,14 @@ async def websocket_endpoint(websocket: WebSocket):
     
     try:
         # Gửi thông báo chào mừng
-        await websocket_manager.send_personal_message(
-            json.dumps({
+        websocket_manager.send_personal_message(
+            json_dumps({
                 'type': 'welcome',
                 'message': 'Connected to Willhaben Crawler',
                 'timestamp': datetime.now().isoformat()
             }),
-            websocket
+            websocket,
+            'welcome'
         )
         
         # Gửi new_listings_array ban đầu nếu có
@@ -1495,20 +1829,23 @@ async def websocket_endpoint(websocket: WebSocket):
                 'count': len(new_listings_copy)
             }
             # logger.info(f"Sending initial_listings to new client: {len(new_listings_copy)} items")
-            await websocket_manager.send_personal_message(
-                json.dumps(initial_message),
-                websocket
+            websocket_manager.send_personal_message(
+                json_dumps(initial_message),
+                websocket,
+                'initial_listings'
             )
         
-        # Giữ kết nối mở
+        # Giữ kết nối mở, chỉ nhận ping; việc gửi do writer task của kết nối đảm nhận
         while True:
             try:
-                # Đợi tin nhắn từ client (có thể là ping)
-                data = await websocket.receive_text()
+                # Keepalive dùng ping/pong frame của giao thức (uvicorn xử lý), ở đây chỉ cần phát hiện ngắt kết nối
+                message = await websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
                 
-                # Phản hồi ping
-                if data == "ping":
-                    await websocket_manager.send_personal_message("pong", websocket)
+                # Tương thích client cũ còn gửi "ping" dạng text
+                if message.get('text') == "ping":
+                    websocket_manager.send_personal_message("pong", websocket, 'pong')
                     
             except WebSocketDisconnect:
                 break
@@ -1532,6 +1869,9 @@ if __name__ == "__main__":
         app,
         host="0.0.0.0",
         port=8000,
+        ws_per_message_deflate=False,  # Payload nhỏ, tránh nén zlib riêng cho từng client mỗi lần broadcast
+        ws_ping_interval=Config.WS_PING_INTERVAL,
+        ws_ping_timeout=Config.WS_PING_TIMEOUT,
         log_level="info",
-        access_log=True
+        access_log=Config.ACCESS_LOG
     )